@@ -1,23 +1,39 @@
 import argparse
+from array import array
 from dataclasses import dataclass, field
 import datetime
+import hashlib
+from itertools import zip_longest
 import json
 import logging
+from operator import itemgetter
 import os
 from pathlib import Path
+import re
 import time
-from typing import List
 
 
 import googleapiclient.discovery
+from googleapiclient.model import JsonModel
 from google.oauth2 import service_account
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 
 SPREADSHEET_ID = "1e_qMx2egdqsUFI_46u0JW1daivNzeVteudA5BwY-8oM"
 DEVICE_SN = "z6-07496"
 REQUEST_INTERVAL = 7  # in days
 ZENTRA_RATE_LIMIT = 60  # in seconds
+ZENTRA_SETTLE_TIME = 1  # in days, after which all readings are assumed to be uploaded
+CACHE_DIR = Path.home() / ".cache" / "fog_collector"
+ZENTRA_CACHE_DIR = CACHE_DIR / "zentra"
+SHEET_ID_FILE = CACHE_DIR / "sheet_id.json"
 
 
 S_OK = 200
@@ -25,116 +41,355 @@ S_LOCKED = 423
 S_RATE_LIMITED = 429
 
 
-def query_zentra_raw(token, start_date, end_date, page_num, per_page):
-    url = "https://zentracloud.com/api/v3/get_readings/"
-    headers = {"content-type": "application/json", "Authorization": f"Token {token}"}
-    params = {
+# Every retry is another request against the sensor's rate limit, so none are sent sooner than that
+# unless ZENTRA asks for it with a `Retry-After` header, which takes precedence over the backoff
+class ZentraRetry(Retry):
+    def get_backoff_time(self):
+        return max(ZENTRA_RATE_LIMIT, super().get_backoff_time())
+
+
+def make_session():
+    # Once these are used up the last lockout response is returned, and `fetch_zentra_page` leaves
+    # the page to be retried
+    retries = ZentraRetry(
+        total=3,
+        backoff_factor=ZENTRA_RATE_LIMIT,
+        status_forcelist=[S_LOCKED, S_RATE_LIMITED, 500, 502, 503],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared so that the TLS connection to ZENTRA is kept alive between pages
+_SESSION = make_session()
+
+
+# Used as a context manager around each request, so that each one starts at least `interval` seconds
+# after the previous one finished
+class RateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+
+    def __enter__(self):
+        if self._last is not None:
+            time.sleep(max(0, self.interval - (time.monotonic() - self._last)))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._last = time.monotonic()
+
+
+# ZENTRA only allows one request per sensor per minute
+_ZENTRA_LIMITER = RateLimiter(ZENTRA_RATE_LIMIT)
+
+
+# Dates are passed as strings, in the same format `requests` would give a `datetime`
+def zentra_params(start_str, end_str, page_num, per_page):
+    return {
         "device_sn": DEVICE_SN,
-        "start_date": start_date,
-        "end_date": end_date,
+        "start_date": start_str,
+        "end_date": end_str,
         "page_num": page_num,
         "per_page": per_page,
     }
-    return requests.get(url, params=params, headers=headers)
+
+
+def query_zentra_raw(token, start_str, end_str, page_num, per_page):
+    url = "https://zentracloud.com/api/v3/get_readings/"
+    headers = {
+        "content-type": "application/json",
+        "Authorization": f"Token {token}",
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip",
+    }
+    params = zentra_params(start_str, end_str, page_num, per_page)
+    return _SESSION.get(url, params=params, headers=headers)
+
+
+# Pages are cached under a hash of the parameters used to request them
+def zentra_cache_file(start_str, end_str, page_num, per_page):
+    params = zentra_params(start_str, end_str, page_num, per_page)
+    key = json.dumps(params, sort_keys=True).encode()
+    return ZENTRA_CACHE_DIR / f"{hashlib.sha256(key).hexdigest()}.json"
+
+
+def write_cache_file(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(content)
+    tmp.replace(path)
+
+
+def prune_cache(max_age):
+    if not ZENTRA_CACHE_DIR.is_dir():
+        return
+    cutoff = time.time() - max_age.total_seconds()
+    for path in ZENTRA_CACHE_DIR.glob("*.json"):
+        if path.stat().st_mtime < cutoff:
+            path.unlink()
 
 
 @dataclass
 class PortData:
     sensor_name: str
-    ts: List[int] = field(default_factory=list)  # timestamps
-    vs: List[float] = field(default_factory=list)  # values
+    # Typed arrays store each reading in 8 bytes instead of as a pointer to a boxed Python number
+    ts: array = field(default_factory=lambda: array("q"))  # timestamps
+    vs: array = field(default_factory=lambda: array("d"))  # values
+
+
+# Returns the raw JSON of a page, or None if ZENTRA has locked us out and the page should be retried
+def fetch_zentra_page(token, start_str, end_str, page_num, per_page):
+    with _ZENTRA_LIMITER:
+        response = query_zentra_raw(token, start_str, end_str, page_num, per_page)
+
+        # The limiter already spaces the retry out by the rate limit, so only a longer lockout needs
+        # any extra waiting
+        retry_after = response.headers.get("Retry-After")
+        if response.status_code in (S_LOCKED, S_RATE_LIMITED) and retry_after:
+            lockout = ZentraRetry().parse_retry_after(retry_after)
+            time.sleep(max(0, lockout - ZENTRA_RATE_LIMIT))
+
+    if response.status_code == S_OK:
+        return response.content
+    elif response.status_code in (S_LOCKED, S_RATE_LIMITED):
+        logging.info(f"ZENTRA lockout recieved, waiting to retry...")
+    else:
+        response.raise_for_status()
+    return None
+
+
+_get_timestamp = itemgetter("timestamp_utc")
+_get_value = itemgetter("value")
+
+
+# Appends the readings in a page to `result`, returning the timestamp of the earliest reading of
+# each port on the page, or None if the page has no precipitation data. The decoded page only lives
+# for the duration of this call, so at most one page is held in memory at a time
+def merge_zentra_page(result, raw):
+    content = _json.loads(raw)
+    if "data" not in content or "Precipitation" not in content["data"]:
+        return None
+
+    page_earliest = []
+    for port_data in content["data"]["Precipitation"]:
+        port = port_data["metadata"]["port_number"]
+        port_result = result.get(port)
+        if port_result is None:
+            sensor_name = port_data["metadata"]["sensor_name"]
+            port_result = result[port] = PortData(sensor_name=sensor_name)
+
+        readings = port_data["readings"]
+        if readings:
+            page_earliest.append(readings[-1]["timestamp_utc"])
+
+        # A reading the logger failed to take comes back with a null value, which the typed arrays
+        # can't hold, so it's left out of both columns
+        readings = [r for r in readings if r["value"] is not None]
+        port_result.ts.extend(map(_get_timestamp, readings))
+        port_result.vs.extend(map(_get_value, readings))
+    return page_earliest
 
 
 # Returns a mapping from port number to `PortData`
 def query_zentra(token, start_date, end_date):
     assert end_date >= start_date
 
-    per_page = 1000
+    per_page = 2000  # the largest page ZENTRA will serve
     start_time = int(start_date.timestamp())
     end_time = int(end_date.timestamp())
+    start_str = start_date.isoformat(sep=" ")
+    end_str = end_date.isoformat(sep=" ")
 
     result = {}
     earliest_seen = end_time
     page_num = 1
 
     while earliest_seen > start_time:
-        response = query_zentra_raw(token, start_date, end_date, page_num, per_page)
-        response_time = time.time()
-
-        if response.status_code == S_OK:
-            content = json.loads(response.content)
-
-            # This happens only when the distance between `earliest_seen` and `start_time` is
-            # smaller than the interval between precipitation measurements
-            if "data" not in content or "Precipitation" not in content["data"]:
-                break
-
-            data = content["data"]["Precipitation"]
-            for port_data in data:
-                port = port_data["metadata"]["port_number"]
-                if port not in result:
-                    sensor_name = port_data["metadata"]["sensor_name"]
-                    result[port] = PortData(sensor_name=sensor_name)
-
-                for reading in port_data["readings"]:
-                    result[port].ts.append(reading["timestamp_utc"])
-                    result[port].vs.append(reading["value"])
-
-            earliest_seen = max([port_result.ts[-1] for port_result in result.values()])
-            page_num += 1
-
-            progress = (end_time - earliest_seen) * 100 // (end_time - start_time)
-            logging.info(f"ZENTRA data processed: {progress}%")
-        elif response.status_code == S_LOCKED or response.status_code == S_RATE_LIMITED:
-            logging.info(f"ZENTRA lockout recieved, waiting to retry...")
+        cache_file = zentra_cache_file(start_str, end_str, page_num, per_page)
+        cached = cache_file.exists()
+        if cached:
+            raw = cache_file.read_bytes()
         else:
-            response.raise_for_status()
-
-        # ZENTRA only allows one request per sensor per minute
-        time.sleep(max(0, ZENTRA_RATE_LIMIT - (time.time() - response_time)))
-
-    return result
+            raw = fetch_zentra_page(token, start_str, end_str, page_num, per_page)
+            if raw is None:
+                continue
 
+        # There's no need to decode on another thread: `_ZENTRA_LIMITER` counts the minute from when
+        # this page arrived, so decoding it already overlaps the wait for the next request
+        page_earliest = merge_zentra_page(result, raw)
 
-# Iterate over data returned by `query_zentra` in "row-major" order
-def zentra_row_iter(data):
-    def inner(i):
-        for port_data in data.values():
-            if i < len(port_data.ts):
-                yield port_data.ts[i]
-                yield port_data.vs[i]
-            else:
-                yield None
-                yield None
+        # This happens only when the distance between `earliest_seen` and `start_time` is smaller
+        # than the interval between precipitation measurements
+        if page_earliest is None:
+            break
 
-    l = max(len(port_data.ts) for port_data in data.values())
-    for i in range(l):
-        yield inner(i)
+        # Only ports present on this page are considered, so a port that has run out of readings
+        # can't hold `earliest_seen` back and keep the query paginating forever
+        earliest_seen = max(page_earliest, default=start_time)
+        page_num += 1
 
+        # The page that ends the query is always fetched fresh, so a rerun confirms the end of the
+        # data with ZENTRA
+        if not cached and earliest_seen > start_time:
+            write_cache_file(cache_file, raw)
 
-def sheets_cell_number(v):
-    return {"userEnteredValue": {"numberValue": v}} if v is not None else {}
+        progress = (end_time - earliest_seen) * 100 // (end_time - start_time)
+        logging.info(f"ZENTRA data processed: {progress}%")
 
+    return result
 
-def sheets_cell_string(s):
-    return {"userEnteredValue": {"stringValue": s}} if s is not None else {}
 
+# Combines mappings returned by `query_zentra`, given newest first. Where their readings overlap,
+# the newer mapping's are kept
+def merge_port_data(results):
+    merged = {}
+    for result in results:
+        for port, port_data in result.items():
+            if port not in merged:
+                merged[port] = PortData(sensor_name=port_data.sensor_name)
+            ts, vs = merged[port].ts, merged[port].vs
+
+            skip = 0
+            while ts and skip < len(port_data.ts) and port_data.ts[skip] >= ts[-1]:
+                skip += 1
+            ts.extend(port_data.ts[skip:])
+            vs.extend(port_data.vs[skip:])
+    return merged
+
+
+# Drops readings from before `start_time`, along with any ports that are left without readings
+def trim_port_data(data, start_time):
+    for port in list(data):
+        port_data = data[port]
+        n = len(port_data.ts)
+        while n and port_data.ts[n - 1] < start_time:
+            n -= 1
+        if n == 0:
+            del data[port]
+        else:
+            del port_data.ts[n:]
+            del port_data.vs[n:]
 
-# The resulting update treats each set of precipitation values as a column, since the Google sheets
-# API only allows 25 columns to be appended in each request
-def cell_update_from_data(data):
-    updates = []
 
+# Each port's timestamps and values become a pair of columns under a shared header, which is the
+# layout the chart in `client/graph.js` reads back
+def cell_rows_from_data(data):
     headers = []
     for port, port_data in data.items():
-        header = f"Port {port}: {port_data.sensor_name}"
-        headers.append(sheets_cell_string(header))  # timestamps column header
-        headers.append(sheets_cell_string(header))  # values column header
-    updates.append({"values": headers})
+        header = {
+            "userEnteredValue": {"stringValue": f"Port {port}: {port_data.sensor_name}"}
+        }
+        headers.append(header)  # timestamps column header
+        headers.append(header)  # values column header
+
+    # Cells are built a column at a time and then transposed into rows, padding ports with fewer
+    # readings with empty cells
+    cols = []
+    for port_data in data.values():
+        cols.append([{"userEnteredValue": {"numberValue": t}} for t in port_data.ts])
+
+        # Precipitation values repeat a lot (most of them are zero), so rather than allocating a
+        # cell per reading, each distinct value gets one cell that is shared between its readings
+        cells = {v: {"userEnteredValue": {"numberValue": v}} for v in set(port_data.vs)}
+        cols.append(list(map(cells.__getitem__, port_data.vs)))
+    rows = [{"values": headers}]
+    rows.extend({"values": list(row)} for row in zip_longest(*cols, fillvalue={}))
+    return rows
+
+
+_HEADER_PATTERN = re.compile(r"Port (\d+): (.*)")
+
+
+# Parses the values written by a previous update back into the mapping returned by `query_zentra`.
+# Returns None if the sheet isn't laid out the way `cell_rows_from_data` writes it
+def port_data_from_values(values):
+    if not values:
+        return {}
+
+    headers = values[0]
+    cols = list(zip_longest(*values[1:], fillvalue=""))
+    if len(headers) % 2 != 0 or len(cols) > len(headers):
+        return None
+    cols.extend(() for _ in range(len(headers) - len(cols)))
+
+    result = {}
+    for i in range(0, len(headers), 2):
+        match = _HEADER_PATTERN.fullmatch(str(headers[i]))
+        if match is None or headers[i + 1] != headers[i]:
+            return None
+        port_data = PortData(sensor_name=match.group(2))
+        try:
+            port_data.ts.extend(int(t) for t in cols[i] if t != "")
+            port_data.vs.extend(float(v) for v in cols[i + 1] if v != "")
+        except (TypeError, ValueError):
+            return None
+        if len(port_data.ts) != len(port_data.vs):
+            return None
+        # Readings are merged and trimmed on the assumption that they're ordered newest first
+        if any(t <= u for t, u in zip(port_data.ts, port_data.ts[1:])):
+            return None
+        # A port without any readings left has nothing to merge with, and no latest reading
+        if port_data.ts:
+            result[int(match.group(1))] = port_data
+    return result
+
+
+def read_sheet_data(service, sheet_id):
+    body = {
+        "dataFilters": [{"gridRange": {"sheetId": sheet_id}}],
+        "valueRenderOption": "UNFORMATTED_VALUE",
+    }
+    response = (
+        service.spreadsheets()
+        .values()
+        .batchGetByDataFilter(spreadsheetId=SPREADSHEET_ID, body=body)
+        .execute()
+    )
+    value_ranges = response.get("valueRanges", [])
+    values = value_ranges[0]["valueRange"].get("values", []) if value_ranges else []
+    return port_data_from_values(values)
+
+
+# googleapiclient serializes request bodies with the stdlib json module. The rows of the sheet make
+# for a large batch update body, so it's serialized with orjson instead when that's installed
+class FastJsonModel(JsonModel):
+    def serialize(self, body_value):
+        if (
+            isinstance(body_value, dict)
+            and "data" not in body_value
+            and self._data_wrapper
+        ):
+            body_value = {"data": body_value}
+        return _json.dumps(body_value)
+
+
+# The ID of a sheet never changes, so it's only looked up when it hasn't been cached yet
+def get_sheet_id(service, refresh=False):
+    if not refresh and SHEET_ID_FILE.exists():
+        try:
+            cached = _json.loads(SHEET_ID_FILE.read_bytes())
+            if cached.get("spreadsheet_id") == SPREADSHEET_ID:
+                return cached["sheet_id"]
+        except (AttributeError, KeyError, ValueError):
+            logging.warning("Cached sheet ID not readable, looking it up again")
+
+    # https://stackoverflow.com/questions/38245714/get-list-of-sheets-and-latest-sheet-in-google-spreadsheet-api-v4-in-python
+    metadata = (
+        service.spreadsheets()
+        .get(spreadsheetId=SPREADSHEET_ID, fields="sheets.properties.sheetId")
+        .execute()
+    )
+    sheets = metadata.get("sheets", "")
+    sheet_id = sheets[0].get("properties", {}).get("sheetId", 0)
 
-    for row in zentra_row_iter(data):
-        updates.append({"values": [sheets_cell_number(val) for val in row]})
-    return updates
+    cached = {"spreadsheet_id": SPREADSHEET_ID, "sheet_id": sheet_id}
+    write_cache_file(SHEET_ID_FILE, json.dumps(cached).encode())
+    return sheet_id
 
 
 def main():
@@ -149,6 +404,16 @@ def main():
         "zentra_token_file",
         help="A file containing the API token to be used when accessing ZENTRA. This token should NOT include the 'Token ' prefix.",
     )
+    parser.add_argument(
+        "--refresh-sheet-id",
+        action="store_true",
+        help="Look up the ID of the sheet to update again, instead of using the cached one.",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="Query ZENTRA for the whole request interval, instead of only the readings newer than those already in the sheet.",
+    )
     args = parser.parse_args()
 
     token = Path(args.zentra_token_file).read_text()
@@ -158,39 +423,73 @@ def main():
         args.service_account_file
     )
     creds = creds.with_scopes(scopes)
-    service = googleapiclient.discovery.build("sheets", "v4", credentials=creds)
+    service = googleapiclient.discovery.build(
+        "sheets", "v4", credentials=creds, model=FastJsonModel()
+    )
 
-    # https://stackoverflow.com/questions/38245714/get-list-of-sheets-and-latest-sheet-in-google-spreadsheet-api-v4-in-python
-    metadata = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-    sheets = metadata.get("sheets", "")
-    sheet_id = sheets[0].get("properties", {}).get("sheetId", 0)
+    sheet_id = get_sheet_id(service, refresh=args.refresh_sheet_id)
 
-    end_date = datetime.datetime.now()
+    # Snapping to the hour lets reruns within the same hour reuse cached ZENTRA pages
+    end_date = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
     start_date = end_date - datetime.timedelta(days=REQUEST_INTERVAL)
+
+    # Readings already in the sheet are kept, so only newer ones have to be requested from ZENTRA
+    existing = {}
+    if not args.full_refresh:
+        try:
+            existing = read_sheet_data(service, sheet_id)
+        except Exception as e:
+            logging.error(f"Request to Google failed:\n{e}")
+            return
+        if existing is None:
+            logging.warning("Sheet layout not recognized, replacing its contents")
+            existing = {}
+
+    query_start = start_date
+    latest = max((port_data.ts[0] for port_data in existing.values()), default=None)
+    if latest is not None:
+        # Readings can be uploaded late, so anything that may not have settled is requested again
+        settled = datetime.datetime.fromtimestamp(latest) - datetime.timedelta(
+            days=ZENTRA_SETTLE_TIME
+        )
+        query_start = min(max(start_date, settled), end_date)
+
+    prune_cache(datetime.timedelta(days=REQUEST_INTERVAL))
     try:
-        data = query_zentra(token, start_date, end_date)
+        data = query_zentra(token, query_start, end_date)
     except Exception as e:
         logging.error(f"Request to ZENTRA failed:\n{e}")
         return
 
-    # https://googleapis.github.io/google-api-python-client/docs/dyn/sheets_v4.spreadsheets.html
+    data = merge_port_data([data, existing])
+    trim_port_data(data, int(start_date.timestamp()))
+    if not data:
+        logging.warning("No ZENTRA data to write")
+        return
+
     # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/batchUpdate
+    # The grid is resized to fit the new data exactly, which drops anything left over from a larger
+    # previous update, and every cell in it is then overwritten. Both happen in a single request, and
+    # batch updates are applied atomically, so the chart never reads a cleared or half-written sheet
+    rows = cell_rows_from_data(data)
     body = {
         "requests": [
             {
-                "deleteRange": {
-                    "range": {
+                "updateSheetProperties": {
+                    "properties": {
                         "sheetId": sheet_id,
-                        "startRowIndex": 0,
-                        "startColumnIndex": 0,
+                        "gridProperties": {
+                            "rowCount": len(rows),
+                            "columnCount": len(rows[0]["values"]),
+                        },
                     },
-                    "shiftDimension": "ROWS",
-                },
+                    "fields": "gridProperties.rowCount,gridProperties.columnCount",
+                }
             },
             {
-                "appendCells": {
-                    "sheetId": sheet_id,
-                    "rows": cell_update_from_data(data),
+                "updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                    "rows": rows,
                     "fields": "userEnteredValue",
                 }
             },
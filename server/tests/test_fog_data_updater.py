@@ -1,5 +1,269 @@
+from array import array
+import datetime
+import json
+import time
+
+import googleapiclient.discovery
+from googleapiclient.http import HttpMockSequence
+import requests
+from urllib3.response import HTTPResponse
+
 from fog_data_updater import __version__
+from fog_data_updater import update
+from fog_data_updater.update import (
+    S_LOCKED,
+    S_RATE_LIMITED,
+    SPREADSHEET_ID,
+    ZENTRA_RATE_LIMIT,
+    FastJsonModel,
+    PortData,
+    RateLimiter,
+    ZentraRetry,
+    cell_rows_from_data,
+    fetch_zentra_page,
+    get_sheet_id,
+    merge_port_data,
+    merge_zentra_page,
+    port_data_from_values,
+    query_zentra,
+    trim_port_data,
+)
+
+
+def port_data(sensor_name, ts, vs):
+    return PortData(sensor_name=sensor_name, ts=array("q", ts), vs=array("d", vs))
+
+
+# Reads cell rows back the way the Sheets API returns them with UNFORMATTED_VALUE: empty cells are
+# empty strings, and trailing empty cells are left out
+def values_from_cell_rows(rows):
+    values = []
+    for row in rows:
+        row_values = [
+            next(iter(cell["userEnteredValue"].values())) if cell else ""
+            for cell in row["values"]
+        ]
+        while row_values and row_values[-1] == "":
+            row_values.pop()
+        values.append(row_values)
+    return values
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_merge_port_data_drops_overlapping_readings():
+    newer = {1: port_data("Rain", [300, 200, 100], [3.0, 2.0, 1.0])}
+    older = {
+        1: port_data("Rain", [200, 100, 0], [9.0, 9.0, 0.5]),
+        2: port_data("Fog", [150], [1.5]),
+    }
+
+    merged = merge_port_data([newer, older])
+
+    assert list(merged) == [1, 2]
+    assert list(merged[1].ts) == [300, 200, 100, 0]
+    assert list(merged[1].vs) == [3.0, 2.0, 1.0, 0.5]
+    assert list(merged[2].ts) == [150]
+
+
+def test_batch_update_request_body():
+    http = HttpMockSequence([({"status": "200"}, "{}")])
+    service = googleapiclient.discovery.build(
+        "sheets", "v4", http=http, model=FastJsonModel()
+    )
+    data = {1: port_data("Pluviómetro", [200, 100], [0.5, 0.0])}
+    body = {"requests": [{"updateCells": {"rows": cell_rows_from_data(data)}}]}
+
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=SPREADSHEET_ID, body=body
+    ).execute()
+
+    _, method, sent, headers = http.request_sequence[0]
+    assert method == "POST"
+    assert headers["content-type"] == "application/json"
+    assert headers["content-length"] == str(len(sent))
+    assert json.loads(sent) == body
+
+
+def test_port_data_round_trips_through_sheet():
+    data = {
+        1: port_data("Rain", [300, 200, 100], [0.0, 0.5, 0.0]),
+        3: port_data("Fog", [250], [1.5]),
+    }
+    values = values_from_cell_rows(cell_rows_from_data(data))
+    assert values[0] == ["Port 1: Rain", "Port 1: Rain", "Port 3: Fog", "Port 3: Fog"]
+
+    parsed = port_data_from_values(values)
+    assert list(parsed) == [1, 3]
+    for port in data:
+        assert parsed[port].sensor_name == data[port].sensor_name
+        assert parsed[port].ts == data[port].ts
+        assert parsed[port].vs == data[port].vs
+
+
+def test_port_data_from_values_drops_empty_ports():
+    assert port_data_from_values([]) == {}
+    assert port_data_from_values([["Port 1: Rain", "Port 1: Rain"]]) == {}
+
+
+def test_port_data_from_values_rejects_unrecognized_layout():
+    assert port_data_from_values([["Timestamp", "Value"], [100, 0.5]]) is None
+    assert port_data_from_values([["Port 1: Rain"], [100]]) is None
+    assert port_data_from_values([["Port 1: Rain", "Port 2: Fog"], [100, 0.5]]) is None
+    assert port_data_from_values([["Port 1: Rain", "Port 1: Rain"], [100]]) is None
+    assert port_data_from_values([["Port 1: Rain", "Port 1: Rain"], ["x", 0.5]]) is None
+    assert (
+        port_data_from_values([["Port 1: Rain", "Port 1: Rain"], [100, 0.5, 7]]) is None
+    )
+
+
+def test_port_data_from_values_rejects_readings_not_newest_first():
+    headers = ["Port 1: Rain", "Port 1: Rain"]
+    assert port_data_from_values([headers, [300, 3.0], [200, 2.0]]) is not None
+    assert port_data_from_values([headers, [100, 1.0], [200, 2.0]]) is None
+    assert port_data_from_values([headers, [200, 2.0], [200, 2.0]]) is None
+
+
+def test_existing_sheet_data_merges_with_new_readings():
+    sheet = {
+        1: port_data("Rain", [200, 100, 0], [2.0, 1.0, 0.5]),
+        2: port_data("Fog", [50], [1.5]),
+    }
+    existing = port_data_from_values(values_from_cell_rows(cell_rows_from_data(sheet)))
+    new = {1: port_data("Rain", [400, 300, 200], [4.0, 3.0, 2.0])}
+
+    merged = merge_port_data([new, existing])
+    trim_port_data(merged, 100)
+    assert list(merged) == [1]
+    assert list(merged[1].ts) == [400, 300, 200, 100]
+    assert list(merged[1].vs) == [4.0, 3.0, 2.0, 1.0]
+
+
+def zentra_page(ports):
+    data = [
+        {
+            "metadata": {"port_number": port, "sensor_name": sensor_name},
+            "readings": [{"timestamp_utc": t, "value": v} for t, v in readings],
+        }
+        for port, sensor_name, readings in ports
+    ]
+    return json.dumps({"data": {"Precipitation": data}}).encode()
+
+
+def test_merge_zentra_page_drops_null_readings():
+    result = {}
+    raw = zentra_page([(1, "Rain", [(300, 0.0), (200, None), (100, 0.5)])])
+
+    page_earliest = merge_zentra_page(result, raw)
+
+    assert page_earliest == [100]
+    assert list(result[1].ts) == [300, 100]
+    assert list(result[1].vs) == [0.0, 0.5]
+
+
+# Serves `page_size` readings per port per page, newest first, the way ZENTRA paginates. Ports that
+# have run out of readings come back with none
+def fake_zentra(monkeypatch, tmp_path, ports, page_size):
+    fetched = []
+
+    def fetch_zentra_page(token, start_str, end_str, page_num, per_page):
+        assert page_num <= 10, "query_zentra kept paginating"
+        fetched.append(page_num)
+        first = (page_num - 1) * page_size
+        return zentra_page(
+            [
+                (port, sensor_name, [(t, 0.0) for t in ts[first : first + page_size]])
+                for port, sensor_name, ts in ports
+            ]
+        )
+
+    monkeypatch.setattr(update, "ZENTRA_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(update, "fetch_zentra_page", fetch_zentra_page)
+    return fetched
+
+
+def test_query_zentra_reaches_start_for_ports_of_different_density(
+    monkeypatch, tmp_path
+):
+    start_date = datetime.datetime(2022, 9, 1)
+    end_date = start_date + datetime.timedelta(seconds=1200)
+    start_time = int(start_date.timestamp())
+    end_time = int(end_date.timestamp())
+    dense = list(range(end_time, start_time - 1, -100))
+    sparse = list(range(end_time, start_time - 1, -400))
+    # A sensor that was disconnected partway through the range runs out of readings early
+    stopped = [end_time, end_time - 200]
+    ports = [(1, "Rain", dense), (2, "Fog", sparse), (3, "Drip", stopped)]
+    fetched = fake_zentra(monkeypatch, tmp_path, ports, page_size=3)
+
+    result = query_zentra("token", start_date, end_date)
+
+    assert list(result[1].ts) == dense
+    assert list(result[2].ts) == sparse
+    assert list(result[3].ts) == stopped
+    assert fetched == [1, 2, 3, 4, 5]
+
+
+def test_query_zentra_only_refetches_final_page(monkeypatch, tmp_path):
+    start_date = datetime.datetime(2022, 9, 1)
+    end_date = start_date + datetime.timedelta(seconds=1200)
+    start_time = int(start_date.timestamp())
+    end_time = int(end_date.timestamp())
+    ts = list(range(end_time, start_time - 1, -100))
+    fetched = fake_zentra(monkeypatch, tmp_path, [(1, "Rain", ts)], page_size=5)
+
+    query_zentra("token", start_date, end_date)
+    fetched.clear()
+    result = query_zentra("token", start_date, end_date)
+
+    assert fetched == [3]
+    assert list(result[1].ts) == ts
+
+
+def test_zentra_retry_backs_off_for_at_least_the_rate_limit(monkeypatch):
+    slept = []
+    monkeypatch.setattr(time, "sleep", slept.append)
+    response = HTTPResponse(status=S_RATE_LIMITED)
+
+    retry = ZentraRetry(total=3, backoff_factor=1)
+    for _ in range(3):
+        retry = retry.increment(method="GET", url="/", response=response)
+        retry.sleep(response)
+
+    assert slept == [ZENTRA_RATE_LIMIT] * 3
+
+
+def test_fetch_zentra_page_waits_out_longer_retry_after(monkeypatch):
+    slept = []
+    monkeypatch.setattr(time, "sleep", slept.append)
+    monkeypatch.setattr(update, "_ZENTRA_LIMITER", RateLimiter(ZENTRA_RATE_LIMIT))
+
+    def query_zentra_raw(token, start_str, end_str, page_num, per_page):
+        response = requests.Response()
+        response.status_code = S_LOCKED
+        response.headers["Retry-After"] = str(ZENTRA_RATE_LIMIT + 90)
+        return response
+
+    monkeypatch.setattr(update, "query_zentra_raw", query_zentra_raw)
+
+    assert fetch_zentra_page("token", "start", "end", 1, 2000) is None
+    assert slept == [90]
+
+
+def test_get_sheet_id_looks_up_unreadable_cache_again(monkeypatch, tmp_path):
+    sheet_id_file = tmp_path / "sheet_id.json"
+    monkeypatch.setattr(update, "SHEET_ID_FILE", sheet_id_file)
+    metadata = json.dumps({"sheets": [{"properties": {"sheetId": 7}}]})
+
+    missing_key = json.dumps({"spreadsheet_id": SPREADSHEET_ID}).encode()
+
+    for content in [b'{"spreadsheet_id": "', b"[]", missing_key]:
+        sheet_id_file.write_bytes(content)
+        http = HttpMockSequence([({"status": "200"}, metadata)])
+        service = googleapiclient.discovery.build("sheets", "v4", http=http)
+
+        assert get_sheet_id(service) == 7
+        assert len(http.request_sequence) == 1
+        assert json.loads(sheet_id_file.read_bytes())["sheet_id"] == 7